@@ -6,22 +6,33 @@ api.py — FastAPI search service
   GET /metrics  -> Prometheus metrics (scraped every 10s)
   GET /docs     -> Swagger UI
 """
+import asyncio
 import os
 import time
 import logging
 import sys
+import threading
+from contextlib import asynccontextmanager
 
+import orjson
 from fastapi import FastAPI, HTTPException, Query
-from opensearchpy import OpenSearch, ConnectionError as OSConnectionError
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
+from opensearchpy import AsyncOpenSearch, ConnectionError as OSConnectionError
+from opensearchpy.exceptions import SerializationError
+from opensearchpy.serializer import JSONSerializer
+from prometheus_client import (
+    CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, multiprocess, CONTENT_TYPE_LATEST,
+)
 from starlette.responses import Response
 
 # ── Config ────────────────────────────────────────────────────────────────────
 OPENSEARCH_HOST = os.getenv("OPENSEARCH_HOST", "http://opensearch:9200")
 LOG_LEVEL       = os.getenv("LOG_LEVEL", "INFO").upper()
 APP_ENV         = os.getenv("APP_ENV", "production")
+OPENSEARCH_POOL_MAXSIZE = int(os.getenv("OPENSEARCH_POOL_MAXSIZE", "64"))
+HEALTH_CACHE_TTL_SEC    = float(os.getenv("HEALTH_CACHE_TTL_SEC", "3"))
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+METRICS_CACHE_TTL_SEC   = float(os.getenv("METRICS_CACHE_TTL_SEC", "5"))   # 0 = render per scrape
+ALLOWED_INDICES         = frozenset(os.getenv("ALLOWED_INDICES", "profiles,users").split(","))
 
 # ── Logging ───────────────────────────────────────────────────────────────────
 logging.basicConfig(
@@ -32,23 +43,66 @@ logging.basicConfig(
 )
 log = logging.getLogger("api")
 
+# ── OpenSearch client ─────────────────────────────────────────────────────────
+class OrjsonSerializer(JSONSerializer):
+    """JSONSerializer backed by orjson — request bodies and responses skip stdlib json."""
+
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data).decode("utf-8")
+        except TypeError:
+            return super().dumps(data)          # types orjson can't encode natively
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as e:
+            raise SerializationError(s, e)
+
+
+os_client = AsyncOpenSearch(
+    hosts=[OPENSEARCH_HOST],
+    serializer=OrjsonSerializer(),
+    http_compress=True,
+    timeout=30,
+    max_retries=3,
+    retry_on_timeout=True,
+    maxsize=OPENSEARCH_POOL_MAXSIZE,
+)
+
 # ── App ───────────────────────────────────────────────────────────────────────
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    if METRICS_CACHE_TTL_SEC > 0:
+        threading.Thread(target=_refresh_metrics, name="metrics-refresh", daemon=True).start()
+    yield
+    await os_client.close()
+
 app = FastAPI(
     title="Search API",
     version="1.0.0",
     description="OpenSearch-backed search API with Prometheus metrics",
     docs_url="/docs",
     redoc_url="/redoc",
+    lifespan=lifespan,
 )
 
-# ── OpenSearch client ─────────────────────────────────────────────────────────
-os_client = OpenSearch(
-    hosts=[OPENSEARCH_HOST],
-    http_compress=True,
-    timeout=30,
-    max_retries=3,
-    retry_on_timeout=True,
-)
+# Constant parts of the search body — shared by every request, never mutated.
+SEARCH_FIELDS    = ["name^2", "bio", "email", "tags"]
+SEARCH_HIGHLIGHT = {"fields": {"name": {}, "bio": {}}}
+
+# Only the parts of a search response the handler returns — everything else
+# (took, _shards, per-hit _index, ...) is dropped server-side before decoding.
+SEARCH_FILTER_PATH = [
+    "hits.total.value",
+    "hits.total.relation",
+    "hits.hits._id",
+    "hits.hits._score",
+    "hits.hits._source",
+    "hits.hits.highlight",
+]
 
 # ── Prometheus metrics ────────────────────────────────────────────────────────
 REQUEST_COUNT = Counter(
@@ -68,19 +122,25 @@ ERROR_COUNT = Counter(
     ["error_type"],
 )
 
-# ── Request logging middleware ────────────────────────────────────────────────
-class LoggingMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        start    = time.time()
-        response = await call_next(request)
-        log.info(
-            f"{request.method} {request.url.path} "
-            f"status={response.status_code} "
-            f"duration={(time.time()-start)*1000:.1f}ms"
-        )
-        return response
+# Label children bound once — labels() hashes the label tuple on every call
+REQUEST_OK       = REQUEST_COUNT.labels(status="success")
+REQUEST_ERROR    = REQUEST_COUNT.labels(status="error")
+# ?index= is caller-controlled — only known indices get their own latency series,
+# everything else shares "other" so the label set stays bounded
+LATENCY_OTHER    = REQUEST_LATENCY.labels(index="other")
+LATENCY_BY_INDEX = {index: REQUEST_LATENCY.labels(index=index) for index in ALLOWED_INDICES}
+ERRORS_BY_TYPE   = {}                           # exception name → ERROR_COUNT child
 
-app.add_middleware(LoggingMiddleware)
+# With several uvicorn workers each process keeps its own samples — in multiprocess
+# mode /metrics aggregates every worker's files instead of reporting just one.
+if PROMETHEUS_MULTIPROC_DIR:
+    METRICS_REGISTRY = CollectorRegistry()
+    multiprocess.MultiProcessCollector(METRICS_REGISTRY)
+else:
+    METRICS_REGISTRY = REGISTRY
+
+# Per-request lines come from uvicorn's access log (see Dockerfile CMD) —
+# no logging middleware on the request path.
 
 # ── Routes ────────────────────────────────────────────────────────────────────
 
@@ -95,19 +155,33 @@ def root():
     }
 
 
+# Probes hit /health every few seconds per replica — serve a recent answer
+# instead of two cluster round-trips each time. Failures are never cached.
+_health_cache = {"t": float("-inf"), "v": None}   # -inf: monotonic() may start near 0 after boot
+_health_lock  = asyncio.Lock()
+
+
 @app.get("/health", summary="Health check")
-def health():
-    """Returns service status and OpenSearch cluster info."""
+async def health():
+    """Returns service status and OpenSearch cluster info (cached for HEALTH_CACHE_TTL_SEC)."""
+    if time.monotonic() - _health_cache["t"] < HEALTH_CACHE_TTL_SEC:
+        return _health_cache["v"]
     try:
-        info    = os_client.info()
-        cluster = os_client.cluster.health()
-        return {
-            "status":         "ok",
-            "env":            APP_ENV,
-            "opensearch":     info["version"]["number"],
-            "cluster_status": cluster["status"],
-            "cluster_name":   cluster["cluster_name"],
-        }
+        async with _health_lock:
+            # Another request may have refreshed the cache while we waited
+            if time.monotonic() - _health_cache["t"] < HEALTH_CACHE_TTL_SEC:
+                return _health_cache["v"]
+            info    = await os_client.info()
+            cluster = await os_client.cluster.health()
+            _health_cache["v"] = {
+                "status":         "ok",
+                "env":            APP_ENV,
+                "opensearch":     info["version"]["number"],
+                "cluster_status": cluster["status"],
+                "cluster_name":   cluster["cluster_name"],
+            }
+            _health_cache["t"] = time.monotonic()
+            return _health_cache["v"]
     except OSConnectionError as e:
         log.error(f"OpenSearch unreachable: {e}")
         raise HTTPException(status_code=503, detail="OpenSearch is unreachable")
@@ -117,50 +191,79 @@ def health():
 
 
 @app.get("/search", summary="Full-text search")
-def search(
+async def search(
     q:     str = Query(...,    description="Search query string"),
     index: str = Query("profiles", description="OpenSearch index name"),
     size:  int = Query(10,     ge=1, le=100, description="Results per page"),
     from_: int = Query(0,      ge=0,         description="Pagination offset", alias="from"),
+    fields: str | None = Query(None,         description="Comma-separated _source fields to return (default: all)"),
+    exact_total: bool = Query(False,         description="Count every match instead of stopping past this page"),
 ):
-    """Full-text search with fuzzy matching, highlighting, and pagination."""
-    start = time.time()
+    """
+    Full-text search with fuzzy matching, highlighting, and pagination.
+    Narrowing `fields` shrinks each hit's _source — less to transfer and decode.
+    Unless `exact_total` is set, matches are only counted one past the current
+    page, so `total` is a lower bound ("total_relation": "gte") when more exist.
+    """
+    latency = LATENCY_BY_INDEX.get(index, LATENCY_OTHER)
+    includes = [f.strip() for f in fields.split(",") if f.strip()] if fields else []
+    kwargs   = {"_source_includes": includes} if includes else {}   # ?fields=, means "all"
     try:
-        result = os_client.search(
-            index=index,
-            body={
-                "from": from_,
-                "size": size,
-                "query": {
-                    "multi_match": {
-                        "query":     q,
-                        "fields":    ["name^2", "bio", "email", "tags"],
-                        "fuzziness": "AUTO",
-                    }
-                },
-                "highlight": {
-                    "fields": {"name": {}, "bio": {}}
+        with latency.time():
+            result = await os_client.search(
+                index=index,
+                body={
+                    "from": from_,
+                    "size": size,
+                    "track_total_hits": True if exact_total else from_ + size + 1,
+                    "query": {
+                        "multi_match": {
+                            "query":     q,
+                            "fields":    SEARCH_FIELDS,
+                            "fuzziness": "AUTO",
+                        }
+                    },
+                    "highlight": SEARCH_HIGHLIGHT,
                 },
-            },
-        )
-        duration = time.time() - start
-        REQUEST_COUNT.labels(status="success").inc()
-        REQUEST_LATENCY.labels(index=index).observe(duration)
+                filter_path=SEARCH_FILTER_PATH,
+                **kwargs,
+            )
+        REQUEST_OK.inc()
+        hits = result["hits"]
         return {
-            "total": result["hits"]["total"]["value"],
+            "total": hits["total"]["value"],
+            "total_relation": hits["total"]["relation"],
             "from":  from_,
             "size":  size,
             "query": q,
-            "hits":  result["hits"]["hits"],
+            "hits":  hits.get("hits", []),      # filter_path omits the key when empty
         }
     except Exception as e:
-        REQUEST_COUNT.labels(status="error").inc()
-        ERROR_COUNT.labels(error_type=type(e).__name__).inc()
+        error_type = type(e).__name__
+        REQUEST_ERROR.inc()
+        (ERRORS_BY_TYPE.get(error_type) or ERRORS_BY_TYPE.setdefault(
+            error_type, ERROR_COUNT.labels(error_type=error_type)
+        )).inc()
         log.error(f"Search failed q={q!r} index={index} error={e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Rendering walks every metric child — do it off the request path, at half the
+# 10s scrape interval, and hand scrapes the latest snapshot.
+_metrics_cache = {"v": b""}
+
+
+def _refresh_metrics():
+    while True:
+        try:
+            _metrics_cache["v"] = generate_latest(METRICS_REGISTRY)   # single store — no lock needed
+        except Exception as e:
+            log.error(f"Metrics refresh failed: {e}")
+        time.sleep(METRICS_CACHE_TTL_SEC)
+
+
 @app.get("/metrics", summary="Prometheus metrics")
 def metrics():
-    """Prometheus-format metrics endpoint — scraped by Prometheus every 15s."""
-    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    """Prometheus-format metrics endpoint — scraped by Prometheus every 10s."""
+    blob = _metrics_cache["v"] or generate_latest(METRICS_REGISTRY)
+    return Response(blob, media_type=CONTENT_TYPE_LATEST)
@@ -5,16 +5,18 @@ Reads Debezium CDC events from Kafka and keeps OpenSearch in sync.
   op c / u / r  →  index (upsert) document
   op d          →  delete document
 """
-import json
 import logging
 import os
 import signal
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from kafka import KafkaConsumer
-from kafka.errors import NoBrokersAvailable
-from opensearchpy import OpenSearch, NotFoundError
+import orjson
+from confluent_kafka import Consumer, KafkaException, TopicPartition
+from opensearchpy import OpenSearch, NotFoundError, helpers
+from opensearchpy.exceptions import SerializationError
+from opensearchpy.serializer import JSONSerializer
 
 # ── Config ────────────────────────────────────────────────────────────────────
 KAFKA_BOOTSTRAP   = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "kafka:9092")
@@ -22,7 +24,16 @@ KAFKA_GROUP_ID    = os.getenv("KAFKA_GROUP_ID",          "opensearch-indexer")
 KAFKA_TOPICS      = os.getenv("KAFKA_TOPICS",            "cdc.dbo.profiles").split(",")
 KAFKA_AUTO_OFFSET = os.getenv("KAFKA_AUTO_OFFSET_RESET", "earliest")
 OPENSEARCH_HOST   = os.getenv("OPENSEARCH_HOST",         "http://opensearch:9200")
+OPENSEARCH_POOL_MAXSIZE = int(os.getenv("OPENSEARCH_POOL_MAXSIZE", "32"))
 LOG_LEVEL         = os.getenv("LOG_LEVEL",               "INFO").upper()
+BULK_SIZE         = int(os.getenv("BULK_SIZE",             "500"))
+BULK_FLUSH_INTERVAL_SEC = float(os.getenv("BULK_FLUSH_INTERVAL_SEC", "1.0"))
+COMMIT_INTERVAL_SEC     = float(os.getenv("COMMIT_INTERVAL_SEC",     "5.0"))
+INDEXER_PARALLELISM     = int(os.getenv("INDEXER_PARALLELISM",       "4"))
+INDEXER_WORKERS         = int(os.getenv("INDEXER_WORKERS",           "4"))   # partitions flushed at once
+# Refresh interval while the indexer runs ("-1" = catch-up mode, "" = leave as is).
+# Either way the indexer refreshes explicitly whenever it has drained the topics.
+INDEX_REFRESH_INTERVAL  = os.getenv("INDEX_REFRESH_INTERVAL", "30s")
 
 # ── Logging ───────────────────────────────────────────────────────────────────
 logging.basicConfig(
@@ -47,126 +58,425 @@ signal.signal(signal.SIGINT,  handle_signal)
 
 def topic_to_index(topic: str) -> str:
     """cdc.dbo.profiles → profiles"""
-    return topic.split(".")[-1].lower()
+    return topic.rsplit(".", 1)[-1].lower()
+
+
+# Subscribed topics are fixed at startup — resolve their indices once
+TOPIC_TO_INDEX = {topic: topic_to_index(topic) for topic in KAFKA_TOPICS}
+
+
+UPSERT_OPS = frozenset(("c", "u", "r"))
+SKIP       = ("skip", "", None)
+
+
+def _row_id(row: dict):
+    """Row primary key as a str, or None — `id` wins over `Id`, and 0 is a valid id."""
+    doc_id = row.get("id")
+    if doc_id is None:
+        doc_id = row.get("Id")
+        if doc_id is None:
+            return None
+    return doc_id if type(doc_id) is str else str(doc_id)
 
 
 def transform(payload: dict):
     """Returns (operation, doc_id, body) — operation is 'index', 'delete', or 'skip'."""
-    op     = payload.get("op", "")
-    after  = payload.get("after")
-    before = payload.get("before")
+    op = payload.get("op")
 
-    if op in ("c", "u", "r") and after:
-        doc_id = str(after.get("id", after.get("Id", "")))
-        return "index", doc_id, after
+    if op in UPSERT_OPS:
+        after = payload.get("after")
+        if after:
+            doc_id = _row_id(after)
+            if doc_id is not None:
+                return "index", doc_id, after
 
-    if op == "d" and before:
-        doc_id = str(before.get("id", before.get("Id", "")))
-        return "delete", doc_id, None
+    elif op == "d":
+        before = payload.get("before")
+        if before:
+            doc_id = _row_id(before)
+            if doc_id is not None:
+                return "delete", doc_id, None
 
-    return "skip", "", None
+    return SKIP
+
+
+def to_action(message):
+    """Kafka message → bulk action dict, or None if the event carries nothing to apply."""
+    raw   = message.value()
+    value = orjson.loads(raw) if raw else None  # tombstones carry no value
+    if not value or "payload" not in value:
+        return None
+
+    topic           = message.topic()
+    index           = TOPIC_TO_INDEX.get(topic) or topic_to_index(topic)
+    op, doc_id, doc = transform(value["payload"])
+
+    if op == "skip" or not doc_id:
+        return None
+    if op == "index":
+        return {"_op_type": "index", "_index": index, "_id": doc_id, "_source": doc}
+    return {"_op_type": "delete", "_index": index, "_id": doc_id}
+
+
+class OrjsonSerializer(JSONSerializer):
+    """JSONSerializer backed by orjson — every bulk line goes through dumps()."""
+
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data).decode("utf-8")
+        except TypeError:
+            return super().dumps(data)          # types orjson can't encode natively
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as e:
+            raise SerializationError(s, e)
 
 
 def make_os_client() -> OpenSearch:
     return OpenSearch(
         hosts=[OPENSEARCH_HOST],
+        serializer=OrjsonSerializer(),
         http_compress=True,
         timeout=30,
         max_retries=3,
         retry_on_timeout=True,
+        # urllib3 keeps a single connection by default; every partition worker's
+        # parallel_bulk threads need one each
+        pool_maxsize=max(OPENSEARCH_POOL_MAXSIZE, INDEXER_WORKERS * INDEXER_PARALLELISM),
     )
 
 
-def make_consumer(retries: int = 10, delay: int = 6) -> KafkaConsumer:
+def make_consumer(on_revoke, retries: int = 10, delay: int = 6) -> Consumer:
     for attempt in range(1, retries + 1):
+        log.info(f"Connecting to Kafka ({KAFKA_BOOTSTRAP}) attempt {attempt}/{retries}...")
+        consumer = Consumer({
+            "bootstrap.servers":    KAFKA_BOOTSTRAP,
+            "group.id":             KAFKA_GROUP_ID,
+            "auto.offset.reset":    KAFKA_AUTO_OFFSET,
+            "enable.auto.commit":   False,      # manual commit = at-least-once delivery
+            "session.timeout.ms":   30000,
+            "heartbeat.interval.ms": 10000,
+            "max.poll.interval.ms": 300000,
+            "fetch.min.bytes":      65536,
+        })
         try:
-            log.info(f"Connecting to Kafka ({KAFKA_BOOTSTRAP}) attempt {attempt}/{retries}...")
-            consumer = KafkaConsumer(
-                *KAFKA_TOPICS,
-                bootstrap_servers=KAFKA_BOOTSTRAP.split(","),
-                group_id=KAFKA_GROUP_ID,
-                auto_offset_reset=KAFKA_AUTO_OFFSET,
-                enable_auto_commit=False,       # manual commit = at-least-once delivery
-                value_deserializer=lambda m: json.loads(m.decode("utf-8")) if m else None,
-                consumer_timeout_ms=5000,       # unblocks loop so SIGTERM is handled
-                session_timeout_ms=30000,
-                heartbeat_interval_ms=10000,
-                max_poll_records=500,
-            )
+            consumer.list_topics(timeout=delay)  # librdkafka connects lazily — probe the brokers
+            consumer.subscribe(KAFKA_TOPICS, on_revoke=on_revoke)
             log.info(f"Connected to Kafka. Topics: {KAFKA_TOPICS}")
             return consumer
-        except NoBrokersAvailable:
+        except KafkaException:
+            consumer.close()
             if attempt == retries:
                 raise
             log.warning(f"Kafka not ready — retrying in {delay}s...")
             time.sleep(delay)
 
 
+def relax_refresh(os_client: OpenSearch, indices) -> dict:
+    """
+    Sets INDEX_REFRESH_INTERVAL on `indices` so bulk ingest isn't cut into a new
+    segment every second. Returns each index's previous value for restore_refresh().
+    """
+    previous = {}
+    if not INDEX_REFRESH_INTERVAL:
+        return previous
+    for index in indices:
+        try:
+            current  = os_client.indices.get_settings(index=index, name="index.refresh_interval")
+            interval = current.get(index, {}).get("settings", {}).get("index", {}).get("refresh_interval")
+            if interval == INDEX_REFRESH_INTERVAL:
+                interval = None                 # left behind by a run that never restored — use the default
+            os_client.indices.put_settings(
+                index=index, body={"index": {"refresh_interval": INDEX_REFRESH_INTERVAL}}
+            )
+            previous[index] = interval
+            log.info(f"refresh_interval {index}: {interval or 'default'} → {INDEX_REFRESH_INTERVAL}")
+        except NotFoundError:
+            log.warning(f"Index {index} not found — leaving its refresh_interval alone")
+        except Exception as e:
+            log.warning(f"Could not relax refresh_interval on {index}: {e}")
+    return previous
+
+
+def restore_refresh(os_client: OpenSearch, previous: dict):
+    """Puts back the refresh intervals captured by relax_refresh() (None = cluster default)."""
+    for index, interval in previous.items():
+        try:
+            os_client.indices.put_settings(index=index, body={"index": {"refresh_interval": interval}})
+        except Exception as e:
+            log.error(f"Could not restore refresh_interval on {index}: {e}")
+
+
+def is_retriable(result: dict) -> bool:
+    """
+    Bulk item failure worth another attempt: 429, 5xx, or the whole request failing
+    in transport. Other 4xx (e.g. a strict-mapping rejection) will never succeed.
+    """
+    status = result.get("status")
+    if "exception" in result or not isinstance(status, int):
+        return True
+    return status == 429 or status >= 500
+
+
+def flush(os_client: OpenSearch, batch: list, pending: dict, retry: dict) -> tuple:
+    """
+    Applies `batch` — a list of ((topic, partition), message, action) in consume
+    order — with bulk requests spread over INDEXER_PARALLELISM threads, and records
+    in `pending`, per partition, the next offset to commit. Permanent failures are
+    logged and skipped like malformed events; the lowest retriable failure per
+    partition goes into `retry` and caps `pending` there, for main() to seek back to.
+    Returns (indexed, deleted, errors).
+    """
+    indexed = deleted = errors = 0
+    failed  = {}                                # tp → lowest retriable failed offset
+
+    # Each CDC event carries the full row, so only the newest action per document
+    # matters. Collapsing to one action per document also means concurrent chunks
+    # can never reorder two writes to the same document.
+    latest = {}
+    for entry in batch:
+        action = entry[2]
+        if action is not None:
+            latest[(action["_index"], action["_id"])] = entry
+    actions = list(latest.values())
+
+    # Chunks never shrink below a share of BULK_SIZE; a batch that fits in one
+    # chunk goes out as a single streaming_bulk request without a thread pool.
+    chunk_size = max(BULK_SIZE // INDEXER_PARALLELISM, -(-len(actions) // INDEXER_PARALLELISM), 1)
+
+    # Skipped events (tombstones, op=skip, no id) have no action — they only
+    # advance `pending` below, so an all-skip batch never touches OpenSearch.
+    if not actions:
+        results = ()
+    elif INDEXER_PARALLELISM > 1 and len(actions) > chunk_size:
+        results = helpers.parallel_bulk(     # yields per-chunk results in submission order
+            os_client,
+            (action for _, _, action in actions),
+            thread_count=INDEXER_PARALLELISM,
+            chunk_size=chunk_size,
+            queue_size=INDEXER_PARALLELISM,
+            raise_on_error=False,
+            raise_on_exception=False,
+            request_timeout=60,
+        )
+    else:
+        results = helpers.streaming_bulk(
+            os_client,
+            (action for _, _, action in actions),
+            chunk_size=BULK_SIZE,
+            raise_on_error=False,
+            raise_on_exception=False,
+            request_timeout=60,
+        )
+    for (tp, message, action), (ok, item) in zip(actions, results):
+        op = action["_op_type"]
+        if ok:
+            if op == "index":
+                indexed += 1
+            else:
+                deleted += 1
+            continue
+
+        result = item.get(op, {})
+        if op == "delete" and result.get("status") == 404:
+            continue                            # already gone — nothing to do
+        errors += 1
+        retriable = is_retriable(result)
+        if retriable:
+            failed[tp] = min(failed.get(tp, message.offset()), message.offset())
+        log.error(
+            f"Failed message topic={message.topic()} "
+            f"partition={message.partition()} offset={message.offset()} "
+            f"{'(will retry)' if retriable else '(skipped)'}: {result.get('error', result)}"
+        )
+
+    # Commit offset only AFTER successful processing
+    for tp, message, _ in batch:
+        if tp in failed and message.offset() >= failed[tp]:
+            continue                            # Do NOT commit — re-consumed after seek
+        pending[tp] = message.offset() + 1
+    retry.update(failed)
+
+    return indexed, deleted, errors
+
+
+def process_partition(os_client: OpenSearch, entries: list, retry: dict) -> tuple:
+    """
+    Worker body: decodes and flushes one partition's ((topic, partition), message)
+    entries, in offset order. Returns (indexed, deleted, errors, pending, indices)
+    where `pending` holds the partition's next offset to commit and `indices` the
+    indices the flush touched. Only this partition's key in `retry` is written.
+    """
+    errors = 0
+    batch  = []
+    for tp, message in entries:
+        try:
+            action = to_action(message)
+        except Exception as e:
+            errors += 1
+            action  = None                      # malformed event — skip past it
+            log.error(
+                f"Failed message topic={message.topic()} "
+                f"partition={message.partition()} offset={message.offset()}: {e}"
+            )
+        batch.append((tp, message, action))
+
+    pending = {}
+    indices = {action["_index"] for _, _, action in batch if action}
+    i, d, e = flush(os_client, batch, pending, retry)
+    return i, d, errors + e, pending, indices
+
+
+def commit(consumer: Consumer, pending: dict, asynchronous: bool = True):
+    """Commits and clears `pending` ((topic, partition) → next offset)."""
+    if not pending:
+        return
+    consumer.commit(
+        offsets=[TopicPartition(topic, partition, offset)
+                 for (topic, partition), offset in pending.items()],
+        asynchronous=asynchronous,
+    )
+    pending.clear()
+
+
 def main():
     log.info("Indexer starting up")
     log.info(f"  Kafka        : {KAFKA_BOOTSTRAP}")
     log.info(f"  Topics       : {KAFKA_TOPICS}")
     log.info(f"  Group        : {KAFKA_GROUP_ID}")
     log.info(f"  OpenSearch   : {OPENSEARCH_HOST}")
-
-    os_client = make_os_client()
-    consumer  = make_consumer()
+    log.info(f"  Bulk         : {BULK_SIZE} docs / {BULK_FLUSH_INTERVAL_SEC}s")
+    log.info(f"  Workers      : {INDEXER_WORKERS} partitions × {INDEXER_PARALLELISM} bulk threads")
+    log.info(f"  Commit every : {COMMIT_INTERVAL_SEC}s")
+    log.info(f"  Refresh      : {INDEX_REFRESH_INTERVAL or 'unchanged'}")
 
     indexed = deleted = errors = 0
-    log.info("Indexer running — waiting for CDC events...")
-
-    while RUNNING:
+    batch       = []                            # ((topic, partition), message) in consume order
+    pending     = {}                            # (topic, partition) → next offset to commit
+    retry       = {}                            # (topic, partition) → offset to re-consume from
+    retry_delay = 0                             # backoff between consecutive retry rounds
+    unrefreshed = set()                         # indices written since the last refresh
+    last_flush  = last_commit = time.monotonic()
+
+    def on_revoke(consumer, partitions):
+        # Runs inside consume(): hand over what we finished before losing the partitions,
+        # and drop unflushed messages — the new owner re-reads them from that offset.
+        revoked = {(p.topic, p.partition) for p in partitions}
         try:
-            for message in consumer:
-                if not RUNNING:
-                    break
-                try:
-                    value = message.value
-                    if not value or "payload" not in value:
-                        consumer.commit()
-                        continue
-
-                    index         = topic_to_index(message.topic)
-                    op, doc_id, doc = transform(value["payload"])
+            commit(consumer, {tp: o for tp, o in pending.items() if tp in revoked}, asynchronous=False)
+        except KafkaException as e:
+            log.warning(f"Commit on revoke failed: {e}")
+        for tp in revoked:
+            pending.pop(tp, None)
+        batch[:] = [entry for entry in batch if entry[0] not in revoked]
 
-                    if op == "skip" or not doc_id:
-                        consumer.commit()
+    os_client = make_os_client()
+    refresh   = {}
+    try:
+        consumer = make_consumer(on_revoke)
+        # Only once Kafka is reachable — and restored however main() exits
+        refresh  = relax_refresh(os_client, set(TOPIC_TO_INDEX.values()))
+        workers  = ThreadPoolExecutor(max_workers=INDEXER_WORKERS, thread_name_prefix="partition")
+
+        log.info("Indexer running — waiting for CDC events...")
+
+        while RUNNING:
+            try:
+                messages = consumer.consume(num_messages=BULK_SIZE, timeout=1.0)
+                for message in messages:
+                    if message.error():
+                        log.warning(f"Kafka error: {message.error()}")
                         continue
-
-                    if op == "index":
-                        os_client.index(index=index, id=doc_id, body=doc)
-                        indexed += 1
-                        log.debug(f"Indexed  {index}/{doc_id}")
-
-                    elif op == "delete":
+                    batch.append(((message.topic(), message.partition()), message))
+
+                due = time.monotonic() - last_flush >= BULK_FLUSH_INTERVAL_SEC
+                if batch and (len(batch) >= BULK_SIZE or due or not RUNNING):
+                    # One task per partition: order within a partition is kept, while
+                    # decoding and OpenSearch round-trips overlap across partitions.
+                    # Rebalance callbacks only fire inside consume(), so none of these
+                    # tasks can be running when on_revoke touches batch/pending.
+                    by_partition = {}
+                    for entry in batch:
+                        by_partition.setdefault(entry[0], []).append(entry)
+                    futures = {workers.submit(process_partition, os_client, entries, retry): entries
+                               for entries in by_partition.values()}
+                    wait(futures)                   # never retry a partition that's still in flight
+                    batch.clear()                   # a failed task must not wedge every later flush
+                    last_flush  = time.monotonic()
+
+                    done_before = indexed + deleted
+                    for future, entries in futures.items():
                         try:
-                            os_client.delete(index=index, id=doc_id)
-                            deleted += 1
-                            log.debug(f"Deleted  {index}/{doc_id}")
-                        except NotFoundError:
-                            pass
-
-                    # Commit offset only AFTER successful processing
-                    consumer.commit()
-
-                    if (indexed + deleted) % 1000 == 0 and (indexed + deleted) > 0:
+                            i, d, e, done, indices = future.result()
+                        except Exception as e:
+                            # Retry the partition from its first message in this flush,
+                            # same as a retriable bulk item failure
+                            tp, message = entries[0]
+                            errors     += len(entries)
+                            retry[tp]   = min(retry.get(tp, message.offset()), message.offset())
+                            log.error(
+                                f"Partition flush failed topic={tp[0]} partition={tp[1]} "
+                                f"offsets={message.offset()}-{entries[-1][1].offset()}: {e}"
+                            )
+                            continue
+                        indexed += i
+                        deleted += d
+                        errors  += e
+                        pending.update(done)
+                        unrefreshed.update(indices)
+
+                    if (indexed + deleted) // 1000 > done_before // 1000:
                         log.info(f"Stats — indexed:{indexed} deleted:{deleted} errors:{errors}")
 
-                except Exception as e:
-                    errors += 1
-                    log.error(
-                        f"Failed message topic={message.topic} "
-                        f"partition={message.partition} offset={message.offset}: {e}"
-                    )
-                    # Do NOT commit — will retry on restart
-
-        except Exception as e:
-            if RUNNING:
-                log.error(f"Consumer loop error: {e} — reconnecting in 5s...")
-                time.sleep(5)
-
-    log.info(f"Stopped — indexed:{indexed} deleted:{deleted} errors:{errors}")
-    consumer.close()
+                    # Rewind partitions with retriable failures; `pending` stops short of
+                    # them, so the re-consumed messages are the next ones to commit
+                    if retry and RUNNING:
+                        retry_delay = min(retry_delay * 2 or 1, 5)
+                        for (topic, partition), offset in retry.items():
+                            try:
+                                consumer.seek(TopicPartition(topic, partition, offset))
+                            except KafkaException as e:
+                                log.warning(f"Seek to {topic}[{partition}]@{offset} failed: {e}")
+                        log.warning(f"Retrying {len(retry)} partition(s) in {retry_delay}s")
+                        time.sleep(retry_delay)
+                    elif not retry:
+                        retry_delay = 0
+                    retry.clear()
+
+                if time.monotonic() - last_commit >= COMMIT_INTERVAL_SEC:
+                    commit(consumer, pending)
+                    last_commit = time.monotonic()
+
+                # Caught up — make everything written so far searchable now rather
+                # than at the next (relaxed) scheduled refresh
+                if not messages and not batch and unrefreshed:
+                    try:
+                        os_client.indices.refresh(
+                            index=",".join(sorted(unrefreshed)), ignore_unavailable=True
+                        )
+                    except Exception as e:
+                        log.warning(f"Refresh of {sorted(unrefreshed)} failed: {e}")
+                    unrefreshed.clear()
+
+            except Exception as e:
+                if RUNNING:
+                    log.error(f"Consumer loop error: {e} — reconnecting in 5s...")
+                    time.sleep(5)
+
+        # Synchronous so the last offsets land before close()
+        try:
+            commit(consumer, pending, asynchronous=False)
+        except KafkaException as e:
+            log.error(f"Final commit failed: {e}")
+        workers.shutdown()
+        log.info(f"Stopped — indexed:{indexed} deleted:{deleted} errors:{errors}")
+        consumer.close()
+    finally:
+        restore_refresh(os_client, refresh)
 
 
 if __name__ == "__main__":